@@ -1,13 +1,16 @@
+import json
 import os
 import signal
 
-from flask import Flask, request, Response, jsonify
+from flask import Flask, request, Response
 from os import environ
 
 from .client import Client
 from .federated_learning_config import FederatedLearningConfig
-from .utils import request_params_to_model_params, model_params_to_request_params
-from .training_type import TrainingType
+from .utils import MAX_PAYLOAD_BYTES, deserialize_params, read_request_payload
+
+# Built once instead of on every unknown route
+PAGE_NOT_FOUND = ('This page does not exist', 404)
 
 CLIENT_URL = environ.get('CLIENT_URL')
 if CLIENT_URL is None:
@@ -16,6 +19,7 @@ if CLIENT_URL is None:
     os.kill(os.getpid(), signal.SIGINT)
 
 app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = MAX_PAYLOAD_BYTES
 client = Client(CLIENT_URL)
 
 
@@ -26,33 +30,41 @@ def index():
 
 @app.route('/training', methods=['POST'])
 def training():
-    training_type = request.json['training_type']
+    # Training settings come in the query string and the model params in the binary body
+    training_type = request.args['training_type']
     print('Request POST /training for training type:', training_type)
-    federated_learning_config = FederatedLearningConfig(request.json['learning_rate'],
-                                                        request.json['epochs'],
-                                                        request.json['batch_size'])
-    model_params = request_params_to_model_params(training_type, request.json)
-    client_id = request.json['client_id']
-    round = request.json['round']
-    # round_size = request.json['round_size']
+    federated_learning_config = FederatedLearningConfig(request.args.get('learning_rate', type=float),
+                                                        request.args.get('epochs', type=int),
+                                                        request.args.get('batch_size', type=int))
+    model_params = deserialize_params(training_type, read_request_payload(request))
+    client_id = request.args.get('client_id', type=int)
+    round = request.args.get('round', type=int)
+    # round_size = request.args.get('round_size', type=int)
      # round_size에 기본값 설정 (에러 방지)
-    round_size = request.json.get('round_size', 1)
-    clients = request.json.get('clients', None)
+    round_size = request.args.get('round_size', 1, type=int)
+    clients = request.args.get('clients')
+    if clients is not None:
+        clients = json.loads(clients)
     client.do_training(training_type, model_params, federated_learning_config, client_id, round, round_size, clients)
     return Response(status=200)
 
 
 @app.route('/model_params', methods=['GET'])
 def get_model_params():
-    model_params = model_params_to_request_params(TrainingType.GOSSIP_MNIST, client.model_params)
-    response = jsonify({'model_params': model_params})
-    response.status_code = 200
+    # Peers that already have these params get a 304
+    etag = client.model_params_etag
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(client.get_encoded_model_params(), status=200, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'max-age=0, must-revalidate'
     return response
 
 
 @app.errorhandler(404)
 def page_not_found(error):
-    return 'This page does not exist', 404
+    return PAGE_NOT_FOUND
 
 
 # ============================================
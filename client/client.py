@@ -1,4 +1,6 @@
 import sys
+import uuid
+import orjson
 import requests
 import torch
 
@@ -7,7 +9,7 @@ from os import environ
 from requests.exceptions import Timeout
 
 # from .deterministic_mnist_model_trainer import DeterministicMnistModelTrainer
-from .utils import model_params_to_request_params
+from .utils import encode_params, model_params_to_request_params
 from .mnist_model_trainer import MnistModelTrainer
 # from .chest_x_ray_model_trainer import ChestXRayModelTrainer
 # from .gossip_mnist_model_trainer import GossipMnistModelTrainer
@@ -21,6 +23,12 @@ class Client:
         self.client_url = client_url
         self.status = ClientStatus.IDLE
         self.training_type = None
+        # Bumped every time model_params is assigned, used to cache the encoded params
+        self.model_params_version = 0
+        # The version starts again from 0 on every restart, so the ETag also needs an id of this process
+        self.__model_params_etag_prefix = uuid.uuid4().hex
+        self.__model_params_cache = None
+        self.__model_params_cache_version = None
         self.model_params = self.__get_initial_params()
         self.SERVER_URL = environ.get('SERVER_URL')
         if self.SERVER_URL is None:
@@ -34,6 +42,29 @@ class Client:
             return
         self.register()
 
+    @property
+    def model_params(self):
+        return self.__model_params
+
+    @model_params.setter
+    def model_params(self, model_params):
+        self.__model_params = model_params
+        self.model_params_version += 1
+
+    @property
+    def model_params_etag(self):
+        return '{}-{}'.format(self.__model_params_etag_prefix, self.model_params_version)
+
+    def get_encoded_model_params(self):
+        # Peers poll the params much more often than they change, so the JSON body
+        # is only encoded again after new params have been assigned
+        model_params_version = self.model_params_version
+        if self.__model_params_cache_version != model_params_version:
+            model_params = model_params_to_request_params(TrainingType.GOSSIP_MNIST, self.model_params)
+            self.__model_params_cache = orjson.dumps({'model_params': model_params})
+            self.__model_params_cache_version = model_params_version
+        return self.__model_params_cache
+
     def __get_initial_params(self):
         weights = torch.randn((28 * 28, 1), dtype=torch.float, requires_grad=True)
         bias = torch.randn(1, dtype=torch.float, requires_grad=True)
@@ -64,8 +95,7 @@ class Client:
                 #     self.model_params = model_params_updated
                 #     self.finish_round()
                 # else:
-                model_params_updated = model_params_to_request_params(training_type, model_params_updated)
-                self.update_model_params_on_server(model_params_updated)
+                self.update_model_params_on_server(model_params_updated, round)
             except Exception as e:
                 raise e
             finally:
@@ -87,13 +117,18 @@ class Client:
             print('Finish round request sent for client', self.client_url)
         sys.stdout.flush()
 
-    def update_model_params_on_server(self, model_params):
+    def update_model_params_on_server(self, model_params, round):
         request_url = self.SERVER_URL + '/model_params'
-        request_body = model_params
-        request_body['client_url'] = self.client_url
-        request_body['training_type'] = self.training_type
+        request_params = {
+            'client_url': self.client_url,
+            'training_type': self.training_type,
+            # The server uses the round to reject late params and to know how stale they are
+            'round': round,
+        }
+        payload = encode_params(self.training_type, model_params)
         print('Sending calculated model weights to central node')
-        response = requests.put(request_url, json=request_body)
+        response = requests.put(request_url, params=request_params, data=payload,
+                                headers={'Content-Type': 'application/octet-stream', 'Content-Encoding': 'gzip'})
         print('Response received from updating central model params:', response)
         if response.status_code != 200:
             print('Error updating central model params. Error:', response.reason)
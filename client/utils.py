@@ -1,9 +1,16 @@
+import gzip
+import io
 import torch
+import zlib
 import numpy as np
 from fastai.torch_core import to_np
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
 
 from .training_type import TrainingType
 
+# Largest model params payload accepted, before and after gunzipping it
+MAX_PAYLOAD_BYTES = 512 * 1024 * 1024
+
 
 def model_params_to_request_params(training_type, model_params):
     if model_params is None:
@@ -25,33 +32,59 @@ def model_params_to_request_params(training_type, model_params):
         raise ValueError('Unsupported training type', training_type)
 
 
-def request_params_to_model_params(training_type, request_data):
-    model_params = None
-
-    if 'weights' not in request_data and 'bias' not in request_data and training_type == TrainingType.GOSSIP_MNIST:
-        return [], []
-
+def serialize_params(training_type, model_params):
+    if model_params is None:
+        return b''
+    buffer = io.BytesIO()
     if (
             training_type == TrainingType.MNIST
             or training_type == TrainingType.DETERMINISTIC_MNIST
             or training_type == TrainingType.GOSSIP_MNIST
     ):
-        weights = torch.tensor(np.array(request_data['weights']), dtype=torch.float, requires_grad=True)
-        bias = torch.tensor(np.array(request_data['bias']), dtype=torch.float, requires_grad=True)
-        model_params = weights, bias
-    # elif training_type == TrainingType.CHEST_X_RAY_PNEUMONIA:
-    #     if 'weights' in request_data:
-    #         weights_array = []
-    #         weights_received = request_data['weights']
-    #         print('Weights received length:', len(weights_received))
-    #         for weights in weights_received:
-    #             numpy_weights_array = np.array(weights)
-    #             print('model weights SHAPE:', numpy_weights_array.shape)
-    #             weights_array.append(np.array(weights))
-    #         model_params = weights_array
-    #     else:
-    #         print('No weights found in the request')
-    #         return None
+        numpy_params = to_np(model_params)
+        np.savez(buffer, weights=numpy_params[0], bias=numpy_params[1])
+    else:
+        raise ValueError('Unsupported training type', training_type)
+    return buffer.getvalue()
+
+
+def encode_params(training_type, model_params):
+    # Level 1 gives most of the size reduction of gzip for a fraction of its CPU cost
+    return gzip.compress(serialize_params(training_type, model_params), compresslevel=1)
+
+
+def read_request_payload(request):
+    data = request.get_data()
+    if request.headers.get('Content-Encoding') == 'gzip':
+        # A small gzip body can expand to any size, so the output is bounded as well
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            data = decompressor.decompress(data, MAX_PAYLOAD_BYTES)
+        except zlib.error:
+            raise BadRequest('Invalid gzip payload')
+        if decompressor.unconsumed_tail:
+            raise RequestEntityTooLarge()
+        if not decompressor.eof:
+            raise BadRequest('Truncated gzip payload')
+    return data
+
+
+def deserialize_params(training_type, data):
+    if not data:
+        if training_type == TrainingType.GOSSIP_MNIST:
+            return [], []
+        print('No model params found in the request')
+        return None
+
+    model_params = None
+    with np.load(io.BytesIO(data)) as arrays:
+        if (
+                training_type == TrainingType.MNIST
+                or training_type == TrainingType.DETERMINISTIC_MNIST
+                or training_type == TrainingType.GOSSIP_MNIST
+        ):
+            weights = torch.tensor(arrays['weights'], dtype=torch.float, requires_grad=True)
+            bias = torch.tensor(arrays['bias'], dtype=torch.float, requires_grad=True)
+            model_params = weights, bias
     print('Model params received length:', len(model_params))
     return model_params
-
@@ -6,9 +6,14 @@ import os
 import sys
 import re
 
+from dotenv import load_dotenv
+
 # 프로젝트 루트를 Python 경로에 추가
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+# Only the flask CLI reads .flaskenv by itself. Variables exported in the shell take precedence
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'client', '.flaskenv'))
+
 def main():
     """클라이언트를 실행하는 메인 함수"""
     # 환경 변수 확인
@@ -30,6 +35,13 @@ def main():
     else:
         port = 5000
     
+    # Flask 개발 서버는 개발 모드에서만 사용 (운영 환경에서는 gunicorn 사용)
+    if os.environ.get('FLASK_ENV') != 'development':
+        print("The Flask development server is only used when FLASK_ENV=development.")
+        print("In production run the client with gunicorn:")
+        print(f"  gunicorn -w 1 -k gthread --threads 8 -b 0.0.0.0:{port} client.app:app")
+        return
+
     # 클라이언트 시작 메시지 출력
     print(f"Starting Federated Learning client on {CLIENT_URL}")
     print(f"Client will listen on port {port}")
@@ -5,16 +5,28 @@
 import os
 import sys
 
+from dotenv import load_dotenv
+
 # 프로젝트 루트를 Python 경로에 추가
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from server import create_app
 
+# Only the flask CLI reads .flaskenv by itself. Variables exported in the shell take precedence
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server', '.flaskenv'))
+
 def main():
     """서버를 실행하는 메인 함수"""
     # 서버 포트 설정 (환경 변수에서 가져오거나 기본값 사용)
     server_port = int(os.environ.get('SERVER_PORT', 8084))
     
+    # Flask 개발 서버는 개발 모드에서만 사용 (운영 환경에서는 gunicorn 사용)
+    if os.environ.get('FLASK_ENV') != 'development':
+        print("The Flask development server is only used when FLASK_ENV=development.")
+        print("In production run the server with gunicorn (a single worker keeps the server state shared):")
+        print(f"  gunicorn -w 1 -k gthread --threads 32 -b 0.0.0.0:{server_port} 'server:create_app()'")
+        return
+
     # 서버 시작 메시지 출력
     print(f"Starting Federated Learning server on port {server_port}")
     print("Server will manage federated learning clients and coordinate training")
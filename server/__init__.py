@@ -1,5 +1,8 @@
 import asyncio
+import logging
 import os
+import threading
+from logging.handlers import MemoryHandler
 
 from flask import (
     Flask, Response, request, render_template, jsonify
@@ -9,19 +12,43 @@ from flask import (
 # from training_type import TrainingType
 # from utils import request_params_to_model_params
 # 상대 임포트를 절대 임포트로 변경
+from server.json_provider import OrjsonProvider
 from server.server import Server
 from server.training_type import TrainingType
-from server.utils import request_params_to_model_params
+from server.utils import MAX_PAYLOAD_BYTES, deserialize_params, read_request_payload
+
+# 404 body shared by the error handler
+PAGE_NOT_FOUND = ('This page does not exist', 404)
+
+logger = logging.getLogger(__name__)
+
+
+def configure_logging():
+    # INFO records are buffered and written in batches instead of flushing stdout on every
+    # message; warnings and errors flush the buffer right away so they are never delayed
+    if not logger.handlers:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        logger.addHandler(MemoryHandler(capacity=100, flushLevel=logging.WARNING, target=stream_handler))
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
 
 
 def create_app(test_config=None):
     # create and configure the app
+    configure_logging()
     app = Flask(__name__, instance_relative_config=True)
-    server = Server()
+    app.json = OrjsonProvider(app)
+    server = Server(async_aggregation=os.environ.get('ASYNC_AGGREGATION') == '1')
+    # Every training round runs on the same event loop, so the server's HTTP
+    # connections to the clients survive between rounds
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name='training-event-loop', daemon=True).start()
 
     app.config.from_mapping(
         SECRET_KEY='dev',
         DATABASE=os.path.join(app.instance_path, 'fl-network.sqlite'),
+        MAX_CONTENT_LENGTH=MAX_PAYLOAD_BYTES,
     )
     # ensure the instance folder exists
     try:
@@ -40,39 +67,46 @@ def create_app(test_config=None):
     @app.route('/training', methods=['POST'])
     def training():
         training_type = request.json['training_type']
-        asyncio.run(server.start_training(training_type))
+        asyncio.run_coroutine_threadsafe(server.start_training(training_type), loop).result()
         return Response(status=200)
 
     @app.route('/client', methods=['POST'])
     def register_client():
-        print('Request POST /client for client_url [', request.form['client_url'], ']')
+        logger.info('Request POST /client for client_url [ %s ]', request.form['client_url'])
         server.register_client(request.form['client_url'])
         return Response(status=201)
 
     @app.route('/client', methods=['DELETE'])
     def unregister_client():
-        print('Request DELETE /client for client_url [', request.form['client_url'], ']')
+        logger.info('Request DELETE /client for client_url [ %s ]', request.form['client_url'])
         server.unregister_client(request.form['client_url'])
         return Response(status=200)
 
     @app.route('/model_params', methods=['PUT'])
     def update_weights():
-        client_url = request.json['client_url']
-        training_type = request.json['training_type']
-        print('Request PUT /model_params for client_url [', client_url, '] and training type:', training_type)
+        client_url = request.args['client_url']
+        training_type = request.args['training_type']
+        logger.info('Request PUT /model_params for client_url [ %s ] and training type: %s', client_url, training_type)
         try:
-            training_client = server.training_clients[request.json['client_url']]
-            server.update_client_model_params(training_type, training_client, request_params_to_model_params(training_type, request.json))
-            return Response(status=200)
+            training_client = server.training_clients[client_url]
+            client_round = request.args.get('round', type=int)
+            if client_round is None:
+                return Response(status=400)
+            model_params = deserialize_params(training_type, read_request_payload(request))
+            if server.is_async_aggregation(training_type):
+                updated = server.apply_async_update(training_type, training_client, model_params, client_round)
+            else:
+                updated = server.update_client_model_params(training_type, training_client, model_params, client_round)
+            return Response(status=200 if updated else 409)
         except KeyError:
-            print('Client', client_url, 'is not registered in the system')
+            logger.warning('Client %s is not registered in the system', client_url)
             return Response(status=401)
 
     @app.route('/finish_round', methods=['POST'])
     def finish_round():
         client_url = request.json['client_url']
         training_type = request.json['training_type']
-        print('Request POST /finish_round for client_url [', client_url, '] and training type:', training_type)
+        logger.info('Request POST /finish_round for client_url [ %s ] and training type: %s', client_url, training_type)
         if training_type == TrainingType.GOSSIP_MNIST:
             training_client = server.training_clients[request.json['client_url']]
             server.finish_round(training_type, training_client)
@@ -83,7 +117,7 @@ def create_app(test_config=None):
 
     @app.errorhandler(404)
     def page_not_found(error):
-        return 'This page does not exist', 404
+        return PAGE_NOT_FOUND
 
     return app
 
@@ -95,6 +129,13 @@ if __name__ == '__main__':
     # 서버 포트 설정 (환경 변수에서 가져오거나 기본값 사용)
     server_port = int(os.environ.get('SERVER_PORT', 8001))
     
+    # Flask 개발 서버는 개발 모드에서만 사용 (운영 환경에서는 gunicorn 사용)
+    if os.environ.get('FLASK_ENV') != 'development':
+        print("The Flask development server is only used when FLASK_ENV=development.")
+        print("In production run the server with gunicorn (a single worker keeps the server state shared):")
+        print(f"  gunicorn -w 1 -k gthread --threads 32 -b 0.0.0.0:{server_port} 'server:create_app()'")
+        raise SystemExit(0)
+
     # 서버 시작 메시지 출력
     print(f"Starting Federated Learning server on port {server_port}")
     print("Server will manage federated learning clients and coordinate training")
@@ -0,0 +1,15 @@
+import orjson
+
+from flask.json.provider import DefaultJSONProvider
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson, which is much faster than the standard json
+    module for float-heavy payloads such as model params. request.json and jsonify use it.
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
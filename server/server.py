@@ -1,18 +1,44 @@
 import asyncio
-import sys
+import json
+import logging
+import os
+import random
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import aiohttp
 import torch
 
 import numpy as np
 
 # 필요한 모듈들 임포트
-from .utils import model_params_to_request_params
-from .federated_learning_config import FederatedLearningConfig
+from .utils import encode_params
 from .client_training_status import ClientTrainingStatus
 from .server_status import ServerStatus
 from .training_client import TrainingClient
+from .training_strategy import get_training_strategy
 from .training_type import TrainingType
 
+logger = logging.getLogger(__name__)
+
+BINARY_HEADERS = {'Content-Type': 'application/octet-stream', 'Content-Encoding': 'gzip'}
+# Bodies bigger than this wait for the client's 100-continue before being uploaded
+EXPECT_CONTINUE_MIN_BYTES = 1024 * 1024
+
+# Model params are sent to the clients quantized to this type, aggregation is always done in float32
+WIRE_DTYPE = np.float16
+# Clients train while answering the training request, so the timeout has to cover a whole local training
+TRAINING_REQUEST_TIMEOUT = 30 * 60
+# Attempts for each training request, waiting 1s, 2s, 4s... between them
+TRAINING_REQUEST_ATTEMPTS = 3
+# Number of peers each client receives in gossip training
+GOSSIP_FANOUT = 3
+# FedAsync (Xie et al.) mixing weight for a client update that is not stale at all
+ASYNC_MIXING_ALPHA = 0.6
+# Client updates older than this number of rounds are discarded in asynchronous aggregation
+ASYNC_MAX_STALENESS = 4
+
 
 class Server:
     """
@@ -20,7 +46,7 @@ class Server:
     - MNIST와 Chest X-Ray 데이터셋에 대한 연합학습을 지원
     - 여러 클라이언트의 학습을 조율하고 모델 파라미터를 집계
     """
-    def __init__(self):
+    def __init__(self, async_aggregation=False):
         # MNIST 모델의 파라미터 (weights, bias)
         self.mnist_model_params = None
         # Chest X-Ray 모델의 파라미터
@@ -29,22 +55,35 @@ class Server:
         self.init_params()
         # 연결된 클라이언트들을 관리하는 딕셔너리
         self.training_clients = {}
+        # 상태별 클라이언트 수 (클라이언트 전체를 순회하지 않고 라운드 상태를 확인하기 위함)
+        self._client_status_counts = Counter()
+        # 이벤트 루프 스레드와 Flask 요청 스레드가 함께 바꾸는 클라이언트 상태, 카운터, 모델 파라미터를 보호하는 락
+        self._lock = threading.RLock()
         # 서버의 현재 상태 (IDLE, CLIENTS_TRAINING 등)
         self.status = ServerStatus.IDLE
         # 현재 학습 라운드 번호
         self.round = 0
+        # 글로벌 모델 파라미터가 마지막으로 집계된 라운드 번호
+        self._last_aggregated_round = None
+        # True이면 라운드 종료를 기다리지 않고 클라이언트 결과를 도착 즉시 반영 (FedAsync)
+        self.async_aggregation = async_aggregation
+        # 클라이언트 요청에 재사용되는 aiohttp 세션 (서버 이벤트 루프에서 처음 사용할 때 생성)
+        self._session = None
+        # 모델 파라미터 직렬화처럼 CPU를 쓰는 작업을 이벤트 루프 밖에서 실행하는 스레드 풀
+        self._cpu_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='fl-server-cpu')
 
     def init_params(self):
         """
         MNIST 모델의 초기 파라미터를 생성하는 메서드
         - 28*28=784 크기의 입력에 대한 가중치와 편향을 무작위로 초기화
-        - requires_grad=True로 설정하여 역전파 시 gradient 계산 가능
+        - 서버는 역전파를 하지 않고 평균만 계산하므로 requires_grad 없이 생성
+          (gradient 계산은 클라이언트에서 파라미터를 받을 때 설정)
         """
         if self.mnist_model_params is None:
             # 입력 크기(784)에서 출력 크기(1)로 가는 가중치 행렬
-            weights = torch.randn((28 * 28, 1), dtype=torch.float, requires_grad=True)
+            weights = torch.empty((28 * 28, 1), dtype=torch.float).normal_()
             # 편향(bias) 벡터
-            bias = torch.randn(1, dtype=torch.float, requires_grad=True)
+            bias = torch.empty(1, dtype=torch.float).normal_()
             self.mnist_model_params = weights, bias
 
     async def start_training(self, training_type):
@@ -54,161 +93,297 @@ class Server:
         - 학습 타입에 따라 다른 설정으로 클라이언트들에게 학습 요청
         """
         if self.status != ServerStatus.IDLE:
-            print('Server is not ready for training yet, status:', self.status)
+            logger.warning('Server is not ready for training yet, status: %s', self.status)
             for training_client in self.training_clients.values():
-                print(training_client)
+                logger.warning('%s', training_client)
         elif len(self.training_clients) == 0:
-            print("There aren't any clients registered in the system, nothing to do yet")
+            logger.warning("There aren't any clients registered in the system, nothing to do yet")
         else:
+            if not self.is_async_aggregation(training_type):
+                # Set before the first await, otherwise a second launch could pass the IDLE
+                # check above while the params are being encoded and start another round
+                self.status = ServerStatus.CLIENTS_TRAINING
             # 학습 라운드 증가 (deterministic MNIST 학습에 필요)
             self.round += 1
 
-            request_body = {}
-            federated_learning_config = None
-            if (
-                    training_type == TrainingType.MNIST
-                    or training_type == TrainingType.DETERMINISTIC_MNIST
-            ):
-                request_body = model_params_to_request_params(training_type, self.mnist_model_params)
-                federated_learning_config = FederatedLearningConfig(learning_rate=1., epochs=20, batch_size=256)
-            elif training_type == TrainingType.GOSSIP_MNIST:
-                request_body = model_params_to_request_params(training_type, None)
-                federated_learning_config = FederatedLearningConfig(learning_rate=1., epochs=20, batch_size=256)
-            elif training_type == TrainingType.CHEST_X_RAY_PNEUMONIA:
-                request_body = model_params_to_request_params(training_type, self.chest_x_ray_model_params)
-                federated_learning_config = FederatedLearningConfig(learning_rate=0.0001, epochs=1, batch_size=2)
-
-            request_body['learning_rate'] = federated_learning_config.learning_rate
-            request_body['epochs'] = federated_learning_config.epochs
-            request_body['batch_size'] = federated_learning_config.batch_size
-            request_body['training_type'] = training_type
-            request_body['round'] = self.round
-
-            if training_type == TrainingType.GOSSIP_MNIST:
-                # Send all client urls and ids to each client for decentralized learning
-                clients = [
+            training_strategy = get_training_strategy(training_type)
+            model_params = self.get_model_params_snapshot(training_strategy)
+            federated_learning_config = training_strategy.federated_learning_config
+
+            # Small values travel in the query string, the body only carries the model params
+            request_params = {
+                'learning_rate': federated_learning_config.learning_rate,
+                'epochs': federated_learning_config.epochs,
+                'batch_size': federated_learning_config.batch_size,
+                'training_type': training_type,
+                'round': self.round,
+            }
+
+            gossip_peers = None
+            if training_strategy.sends_peers:
+                # Client urls and ids for decentralized learning. Each client only receives
+                # a small random sample of them, drawn again every round
+                gossip_peers = [
                     {"client_id": client.client_id, "client_url": client.client_url}
                     for client in self.training_clients.values()
                 ]
-                request_body['clients'] = clients
 
-            print('There are', len(self.training_clients), 'clients registered')
-            tasks = []
-            for training_client in self.training_clients.values():
-                if training_type == TrainingType.DETERMINISTIC_MNIST or training_type == TrainingType.GOSSIP_MNIST:
-                    request_body['round_size'] = len(self.training_clients.values())
-                tasks.append(
-                    asyncio.ensure_future(self.do_training_client_request(training_type, training_client, request_body))
+            if training_strategy.sends_round_size:
+                request_params['round_size'] = len(self.training_clients)
+
+            # The model params are the same for every client, so they are serialized and gzipped only
+            # once per round and shared by all the requests. Serializing runs in the thread
+            # pool so the event loop keeps serving other requests in the meantime
+            payload = await asyncio.get_running_loop().run_in_executor(
+                self._cpu_pool, partial(encode_params, training_type, model_params, dtype=WIRE_DTYPE)
+            )
+
+            logger.info('There are %d clients registered', len(self.training_clients))
+            if self.is_async_aggregation(training_type):
+                # Clients still training a previous round are not waited for, their
+                # results will be merged with a staleness penalty when they arrive
+                training_clients = [
+                    training_client for training_client in self.training_clients.values()
+                    if training_client.status != ClientTrainingStatus.TRAINING_REQUESTED
+                ]
+            else:
+                training_clients = list(self.training_clients.values())
+            # A single pooled session is shared by every request of every round so
+            # connections to the clients are kept alive instead of opened per request
+            session = self.get_client_session()
+            logger.info('Requesting training to clients...')
+            async with asyncio.TaskGroup() as task_group:
+                for training_client in training_clients:
+                    task_group.create_task(
+                        self.request_training_with_retries(
+                            session, training_type, training_client, request_params, payload, gossip_peers
+                        )
+                    )
+
+    def is_async_aggregation(self, training_type):
+        # Gossip training doesn't send params back, so its rounds are always synchronous
+        return self.async_aggregation and get_training_strategy(training_type).blend is not None
+
+    def get_model_params(self, training_strategy):
+        if training_strategy.params_attribute is None:
+            return None
+        return getattr(self, training_strategy.params_attribute)
+
+    def set_model_params(self, training_strategy, model_params):
+        setattr(self, training_strategy.params_attribute, model_params)
+
+    def get_model_params_snapshot(self, training_strategy):
+        # The params are encoded in the thread pool while FedAsync blends may be changing
+        # them in place, so a copy is taken under the lock and encoded instead
+        with self._lock:
+            model_params = self.get_model_params(training_strategy)
+            if model_params is None:
+                return None
+            return training_strategy.copy(model_params)
+
+    def get_client_session(self):
+        # The session is bound to the event loop it's created in, so this must
+        # only be called from the server's long-lived event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=32, ttl_dns_cache=300, keepalive_timeout=75)
+            # No total timeout: clients answer the training request once their training has finished
+            timeout = aiohttp.ClientTimeout(total=None, connect=5)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    @staticmethod
+    def sample_gossip_peers(gossip_peers, client_id):
+        # One extra peer is sampled in case the client itself is picked
+        peers = random.sample(gossip_peers, min(GOSSIP_FANOUT + 1, len(gossip_peers)))
+        return [peer for peer in peers if peer['client_id'] != client_id][:GOSSIP_FANOUT]
+
+    async def request_training_with_retries(self, session, training_type, training_client, request_params, payload,
+                                            gossip_peers=None):
+        # A client that doesn't answer can't block the round forever: each attempt is bounded by
+        # TRAINING_REQUEST_TIMEOUT and the client is marked with an error after the last one
+        for attempt in range(TRAINING_REQUEST_ATTEMPTS):
+            try:
+                await asyncio.wait_for(
+                    self.do_training_client_request(
+                        session, training_type, training_client, request_params, payload, gossip_peers
+                    ),
+                    timeout=TRAINING_REQUEST_TIMEOUT
                 )
-            print('Requesting training to clients...')
-            self.status = ServerStatus.CLIENTS_TRAINING
-            await asyncio.gather(*tasks)
-        sys.stdout.flush()
+                return
+            except (asyncio.TimeoutError, aiohttp.ClientError) as error:
+                logger.warning('Training request to client %s failed (attempt %d of %d): %r',
+                               training_client.client_url, attempt + 1, TRAINING_REQUEST_ATTEMPTS, error)
+                if attempt + 1 < TRAINING_REQUEST_ATTEMPTS:
+                    await asyncio.sleep(2 ** attempt)
+        self.set_training_request_error(training_type, training_client)
+
+    def set_training_request_error(self, training_type, training_client):
+        with self._lock:
+            self._set_status(training_client, ClientTrainingStatus.TRAINING_REQUEST_ERROR)
+            if not self.is_async_aggregation(training_type):
+                self.update_server_model_params(training_type)
 
-    async def do_training_client_request(self, training_type, training_client, request_body):
+    async def do_training_client_request(self, session, training_type, training_client, request_params, payload,
+                                         gossip_peers=None):
         request_url = training_client.client_url + '/training'
-        print('Requesting training to client', request_url)
-        async with aiohttp.ClientSession() as session:
-            # Ensures individual client_ids are sent to each client
-            request_body['client_id'] = training_client.client_id
-            training_client.status = ClientTrainingStatus.TRAINING_REQUESTED
-            async with session.post(request_url, json=request_body) as response:
-                if response.status != 200:
-                    print('Error requesting training to client', training_client.client_url)
-                    training_client.status = ClientTrainingStatus.TRAINING_REQUEST_ERROR
-                    self.update_server_model_params(training_type)
-                else:
-                    print('Client', training_client.client_url, 'started training')
-
-    def update_client_model_params(self, training_type, training_client, client_model_params):
+        logger.info('Requesting training to client %s', request_url)
+        # Ensures individual client_ids are sent to each client without mutating the shared params
+        per_client_params = {**request_params, 'client_id': training_client.client_id}
+        if gossip_peers is not None:
+            per_client_params['clients'] = json.dumps(
+                self.sample_gossip_peers(gossip_peers, training_client.client_id)
+            )
+        self._set_status(training_client, ClientTrainingStatus.TRAINING_REQUESTED)
+        async with session.post(request_url, params=per_client_params, data=payload, headers=BINARY_HEADERS,
+                                expect100=len(payload) > EXPECT_CONTINUE_MIN_BYTES) as response:
+            if response.status != 200:
+                logger.error('Error requesting training to client %s', training_client.client_url)
+                self.set_training_request_error(training_type, training_client)
+            else:
+                logger.info('Client %s started training', training_client.client_url)
+
+    def update_client_model_params(self, training_type, training_client, client_model_params, client_round):
         """
         클라이언트로부터 받은 모델 파라미터를 업데이트하는 메서드
+        - 현재 라운드가 아니거나 이미 집계된 라운드의 파라미터는 거부 (False 반환)
         - 클라이언트의 학습 결과(파라미터)를 저장
         - 클라이언트의 상태를 TRAINING_FINISHED로 변경
         - 서버의 글로벌 모델 파라미터 업데이트를 시도
         """
-        print('New model params received from client', training_client.client_url)
-        training_client.model_params = client_model_params
-        training_client.status = ClientTrainingStatus.TRAINING_FINISHED
-        self.update_server_model_params(training_type)
+        logger.info('New model params received from client %s for round %s', training_client.client_url, client_round)
+        with self._lock:
+            # Rejected before touching the client, so a duplicated or late PUT can't leave it
+            # TRAINING_FINISHED in a round that will never be aggregated again
+            if client_round != self.round or self._last_aggregated_round == self.round:
+                logger.warning('Discarding model params from client %s for round %s, current round is %d',
+                               training_client.client_url, client_round, self.round)
+                return False
+            training_client.model_params = client_model_params
+            self._set_status(training_client, ClientTrainingStatus.TRAINING_FINISHED)
+            self.update_server_model_params(training_type)
+            return True
+
+    def apply_async_update(self, training_type, training_client, client_model_params, client_round):
+        """
+        클라이언트의 모델 파라미터를 도착 즉시 글로벌 모델에 반영하는 메서드 (FedAsync)
+        - staleness: 클라이언트가 학습을 시작한 라운드 이후 지나간 라운드 수
+        - 글로벌 모델과 클라이언트 모델을 staleness에 따라 줄어드는 가중치로 섞음
+        - staleness가 ASYNC_MAX_STALENESS보다 크면 업데이트를 버림
+        - 학습 요청을 받지 않은 클라이언트의 파라미터는 거부 (False 반환)
+        """
+        logger.info('New model params received from client %s for round %s', training_client.client_url, client_round)
+        # The blends change the global params in place, so they must not interleave
+        with self._lock:
+            # Duplicated or retried PUTs find the client IDLE already and must not be blended twice
+            if training_client.status != ClientTrainingStatus.TRAINING_REQUESTED:
+                logger.warning('Discarding model params from client %s, which has no training requested',
+                               training_client.client_url)
+                return False
+            training_client.model_params = client_model_params
+            self._set_status(training_client, ClientTrainingStatus.IDLE)
+            staleness = self.round - client_round
+            if staleness > ASYNC_MAX_STALENESS:
+                logger.warning('Discarding model params from client %s with staleness %d',
+                               training_client.client_url, staleness)
+                return True
+            alpha = ASYNC_MIXING_ALPHA / (1 + staleness)
+            training_strategy = get_training_strategy(training_type)
+            self.set_model_params(
+                training_strategy,
+                training_strategy.blend(self.get_model_params(training_strategy), client_model_params, alpha)
+            )
+        logger.info('Model weights for %s updated in central model with alpha %s', training_type, alpha)
+        return True
 
     # Forces the round to finish. This is used for Gossip training
     # since no parameters will be sent back to the server
     # so the server needs to know when the round is finished
     def finish_round(self, training_type, training_client):
-        training_client.status = ClientTrainingStatus.TRAINING_FINISHED
+        with self._lock:
+            self._set_status(training_client, ClientTrainingStatus.TRAINING_FINISHED)
 
-        if self.can_update_central_model_params() and training_type == TrainingType.GOSSIP_MNIST:
-            self.status = ServerStatus.IDLE
-            for training_client in self.training_clients.values():
-                training_client.status = ClientTrainingStatus.IDLE
-        sys.stdout.flush()
+            if self.can_update_central_model_params() and training_type == TrainingType.GOSSIP_MNIST:
+                self.status = ServerStatus.IDLE
+                for training_client in self.training_clients.values():
+                    self._set_status(training_client, ClientTrainingStatus.IDLE)
 
     def update_server_model_params(self, training_type):
         """
         서버의 글로벌 모델 파라미터를 업데이트하는 메서드
         - 모든 클라이언트의 학습이 완료되었는지 확인
         - 각 클라이언트의 모델 파라미터를 수집하여 평균 계산 (FedAvg 알고리즘)
-        - MNIST와 Chest X-Ray 모델에 대해 각각 다른 방식으로 처리
+        - 학습 타입별 집계 방식은 TRAINING_STRATEGIES에 정의
         """
-        if self.can_update_central_model_params():
-            print('Updating global model params')
+        # The readiness check and the aggregation run under the same lock, so no status
+        # change can slip in between them
+        with self._lock:
+            # Called on every client PUT, so the O(1) readiness check comes before any walk over the clients
+            if not self.can_update_central_model_params():
+                return
+            if self._last_aggregated_round == self.round:
+                # Duplicated params (e.g. retried requests) must not aggregate the same round twice
+                logger.warning('Model params for round %d were already aggregated', self.round)
+                return
+            logger.info('Updating global model params')
             self.status = ServerStatus.UPDATING_MODEL_PARAMS
-            if training_type == TrainingType.MNIST or training_type == TrainingType.DETERMINISTIC_MNIST:
-                received_weights = []
-                received_biases = []
-                for training_client in self.training_clients.values():
-                    if training_client.status == ClientTrainingStatus.TRAINING_FINISHED:
-                        received_weights.append(training_client.model_params[0])
-                        received_biases.append(training_client.model_params[1])
-                        training_client.status = ClientTrainingStatus.IDLE
-                new_weights = torch.stack(received_weights).mean(0)
-                new_bias = torch.stack(received_biases).mean(0)
-                self.mnist_model_params = new_weights, new_bias
-                print('Model weights for', training_type, 'updated in central model')
-            elif training_type == TrainingType.CHEST_X_RAY_PNEUMONIA:
-                received_weights = []
-                for training_client in self.training_clients.values():
-                    if training_client.status == ClientTrainingStatus.TRAINING_FINISHED:
-                        training_client.status = ClientTrainingStatus.IDLE
-                        received_weights.append(training_client.model_params)
-                new_weights = np.stack(received_weights).mean(0)
-                self.chest_x_ray_model_params = new_weights
-                print('Model weights for', TrainingType.CHEST_X_RAY_PNEUMONIA, 'updated in central model')
+            training_strategy = get_training_strategy(training_type)
+            if training_strategy.aggregate is not None:
+                # The average is accumulated in place, one client at a time, instead of
+                # stacking every received tensor before reducing it
+                new_model_params = training_strategy.aggregate(self._pop_finished_clients_model_params())
+                if new_model_params is not None:
+                    self.set_model_params(training_strategy, new_model_params)
+                    logger.info('Model weights for %s updated in central model', training_type)
+                self._last_aggregated_round = self.round
             self.status = ServerStatus.IDLE
-        sys.stdout.flush()
 
-    def can_update_central_model_params(self):
+    def _pop_finished_clients_model_params(self):
+        # Clients are set back to IDLE as their params are consumed by the aggregation
         for training_client in self.training_clients.values():
-            if training_client.status != ClientTrainingStatus.TRAINING_FINISHED \
-                    and training_client.status != ClientTrainingStatus.TRAINING_REQUEST_ERROR:
-                return False
-        return True
+            if training_client.status == ClientTrainingStatus.TRAINING_FINISHED:
+                self._set_status(training_client, ClientTrainingStatus.IDLE)
+                yield training_client.model_params
+
+    def _set_status(self, training_client, status):
+        # Every client status change must go through here to keep the counters right.
+        # It's called from the event loop thread and from the Flask request threads,
+        # and a lost counter update would never be corrected, hence the lock
+        with self._lock:
+            # In-flight requests may still hold a client that was unregistered meanwhile,
+            # its status is no longer counted
+            if self.training_clients.get(training_client.client_url) is training_client:
+                self._client_status_counts[training_client.status] -= 1
+                self._client_status_counts[status] += 1
+            training_client.status = status
+
+    def can_update_central_model_params(self):
+        with self._lock:
+            return self._client_status_counts[ClientTrainingStatus.TRAINING_FINISHED] \
+                + self._client_status_counts[ClientTrainingStatus.TRAINING_REQUEST_ERROR] == len(self.training_clients)
 
     def register_client(self, client_url):
-        print('Registering new training client [', client_url, ']')
-        if self.training_clients.get(client_url) is None:
-            next_client_id = len(self.training_clients) + 1
-            self.training_clients[client_url] = TrainingClient(client_url, next_client_id)
-        else:
-            print('Client [', client_url, '] was already registered in the system')
-            self.training_clients.get(client_url).status = ClientTrainingStatus.IDLE
-        sys.stdout.flush()
+        logger.info('Registering new training client [ %s ]', client_url)
+        with self._lock:
+            if self.training_clients.get(client_url) is None:
+                next_client_id = len(self.training_clients) + 1
+                self.training_clients[client_url] = TrainingClient(client_url, next_client_id)
+                self._client_status_counts[ClientTrainingStatus.IDLE] += 1
+            else:
+                logger.info('Client [ %s ] was already registered in the system', client_url)
+                self._set_status(self.training_clients.get(client_url), ClientTrainingStatus.IDLE)
 
     def unregister_client(self, client_url):
-        print('Unregistering client [', client_url, ']')
+        logger.info('Unregistering client [ %s ]', client_url)
         try:
-            self.training_clients.pop(client_url)
-            print('Client [', client_url, '] unregistered successfully')
+            with self._lock:
+                training_client = self.training_clients.pop(client_url)
+                self._client_status_counts[training_client.status] -= 1
+            logger.info('Client [ %s ] unregistered successfully', client_url)
         except KeyError:
-            print('Client [', client_url, '] is not registered yet')
-        sys.stdout.flush()
+            logger.warning('Client [ %s ] is not registered yet', client_url)
 
     def can_do_training(self):
-        for training_client in self.training_clients.values():
-            if training_client.status != ClientTrainingStatus.IDLE \
-                    and training_client.status != ClientTrainingStatus.TRAINING_REQUEST_ERROR:
-                return False
-
-        return True
+        with self._lock:
+            return self._client_status_counts[ClientTrainingStatus.IDLE] \
+                + self._client_status_counts[ClientTrainingStatus.TRAINING_REQUEST_ERROR] == len(self.training_clients)
 
@@ -0,0 +1,144 @@
+import numpy as np
+import torch
+
+from .federated_learning_config import FederatedLearningConfig
+from .training_type import TrainingType
+from .utils import cast_floating_array
+
+
+def average_mnist_params(clients_model_params):
+    """
+    FedAvg of MNIST (weights, bias) params, accumulated in place one client at a time.
+    Returns None if no params were received.
+    """
+    weights_sum = None
+    bias_sum = None
+    received_count = 0
+    for weights, bias in clients_model_params:
+        if weights_sum is None:
+            weights_sum = weights.clone()
+            bias_sum = bias.clone()
+        else:
+            weights_sum.add_(weights)
+            bias_sum.add_(bias)
+        received_count += 1
+    if received_count == 0:
+        return None
+    return weights_sum.div_(received_count), bias_sum.div_(received_count)
+
+
+def average_chest_x_ray_params(clients_model_params):
+    """
+    FedAvg of Chest X-Ray params (one array per layer), accumulated in place one client at a time.
+    Returns None if no params were received.
+    """
+    weights_sum = None
+    received_count = 0
+    for model_params in clients_model_params:
+        if weights_sum is None:
+            # The first client's params are copied as the starting sum, which saves
+            # adding them to a zero-filled buffer. Integer layers (e.g. batch norm counters)
+            # keep their dtype and the first client's values, they are not averaged
+            weights_sum = [cast_floating_array(np.array(weights), np.float32) for weights in model_params]
+        else:
+            for layer_sum, weights in zip(weights_sum, model_params):
+                if np.issubdtype(layer_sum.dtype, np.floating):
+                    np.add(layer_sum, weights, out=layer_sum, casting='unsafe')
+        received_count += 1
+    if received_count == 0:
+        return None
+    for layer_sum in weights_sum:
+        if np.issubdtype(layer_sum.dtype, np.floating):
+            np.divide(layer_sum, received_count, out=layer_sum)
+    return weights_sum
+
+
+# The global params are blended in place, (1 - alpha) * global + alpha * client,
+# without allocating temporary tensors for each term
+def blend_mnist_params(global_params, client_params, alpha):
+    for global_tensor, client_tensor in zip(global_params, client_params):
+        global_tensor.mul_(1 - alpha).add_(client_tensor, alpha=alpha)
+    return global_params
+
+
+def blend_chest_x_ray_params(global_params, client_params, alpha):
+    if global_params is None:
+        # Copied so the blends don't modify the params stored in the training client
+        return [np.array(weights) for weights in client_params]
+    for global_weights, client_weights in zip(global_params, client_params):
+        if np.issubdtype(global_weights.dtype, np.floating):
+            # torch.from_numpy shares memory with the arrays, so this updates them in place
+            torch.from_numpy(global_weights).mul_(1 - alpha).add_(
+                torch.from_numpy(client_weights.astype(global_weights.dtype, copy=False)), alpha=alpha
+            )
+        else:
+            global_weights[...] = client_weights
+    return global_params
+
+
+def copy_mnist_params(model_params):
+    return tuple(tensor.clone() for tensor in model_params)
+
+
+def copy_chest_x_ray_params(model_params):
+    return [np.array(weights) for weights in model_params]
+
+
+class TrainingStrategy:
+    """
+    Everything the server does differently for each training type:
+    - federated_learning_config: settings sent to the clients
+    - params_attribute: Server attribute holding the global params (None if the server has no params)
+    - aggregate: FedAvg function, receives the params of every finished client
+    - blend: FedAsync function, mixes the params of one client into the global params
+    - copy: returns a copy of the global params that later blends won't modify
+    - sends_round_size / sends_peers: extra settings sent to the clients
+    """
+    def __init__(self, federated_learning_config, params_attribute=None, aggregate=None, blend=None, copy=None,
+                 sends_round_size=False, sends_peers=False):
+        self.federated_learning_config = federated_learning_config
+        self.params_attribute = params_attribute
+        self.aggregate = aggregate
+        self.blend = blend
+        self.copy = copy
+        self.sends_round_size = sends_round_size
+        self.sends_peers = sends_peers
+
+
+TRAINING_STRATEGIES = {
+    TrainingType.MNIST: TrainingStrategy(
+        FederatedLearningConfig(learning_rate=1., epochs=20, batch_size=256),
+        params_attribute='mnist_model_params',
+        aggregate=average_mnist_params,
+        blend=blend_mnist_params,
+        copy=copy_mnist_params,
+    ),
+    TrainingType.DETERMINISTIC_MNIST: TrainingStrategy(
+        FederatedLearningConfig(learning_rate=1., epochs=20, batch_size=256),
+        params_attribute='mnist_model_params',
+        aggregate=average_mnist_params,
+        blend=blend_mnist_params,
+        copy=copy_mnist_params,
+        sends_round_size=True,
+    ),
+    # Gossip clients share their params between them, so no params go through the server
+    TrainingType.GOSSIP_MNIST: TrainingStrategy(
+        FederatedLearningConfig(learning_rate=1., epochs=20, batch_size=256),
+        sends_round_size=True,
+        sends_peers=True,
+    ),
+    TrainingType.CHEST_X_RAY_PNEUMONIA: TrainingStrategy(
+        FederatedLearningConfig(learning_rate=0.0001, epochs=1, batch_size=2),
+        params_attribute='chest_x_ray_model_params',
+        aggregate=average_chest_x_ray_params,
+        blend=blend_chest_x_ray_params,
+        copy=copy_chest_x_ray_params,
+    ),
+}
+
+
+def get_training_strategy(training_type):
+    try:
+        return TRAINING_STRATEGIES[training_type]
+    except KeyError:
+        raise ValueError('Unsupported training type', training_type)
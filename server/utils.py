@@ -1,48 +1,90 @@
+import gzip
+import io
+import logging
 import torch
+import zlib
 import numpy as np
 from fastai.torch_core import to_np
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
 
 from .training_type import TrainingType
 
+logger = logging.getLogger(__name__)
 
-def model_params_to_request_params(training_type, model_params):
+# Largest model params payload accepted, before and after gunzipping it
+MAX_PAYLOAD_BYTES = 512 * 1024 * 1024
+
+
+def cast_floating_array(array, dtype):
+    # Only float arrays are cast, integer ones (e.g. counters in the model state) are kept as they are
+    if dtype is None or not np.issubdtype(array.dtype, np.floating):
+        return array
+    return array.astype(dtype, copy=False)
+
+
+def serialize_params(training_type, model_params, dtype=None):
+    """
+    Serializes the model params into npz bytes. If dtype is given (e.g. np.float16),
+    float arrays are down-cast to it to reduce the size of the payload.
+    """
     if model_params is None:
-        return {}
+        return b''
+    buffer = io.BytesIO()
     if (
             training_type == TrainingType.MNIST
             or training_type == TrainingType.DETERMINISTIC_MNIST
             or training_type == TrainingType.GOSSIP_MNIST
     ):
         numpy_params = to_np(model_params)
-        return {'weights': numpy_params[0].tolist(), 'bias': numpy_params[1].tolist()}
+        np.savez(buffer,
+                 weights=cast_floating_array(numpy_params[0], dtype),
+                 bias=cast_floating_array(numpy_params[1], dtype))
     elif training_type == TrainingType.CHEST_X_RAY_PNEUMONIA:
-        weights_array = []
-        for i, weights in enumerate(model_params):
-            print('model params SHAPE:', weights.shape)
-            weights_array.append(np.array(weights).tolist())
-        return {'weights': weights_array}
+        np.savez(buffer, *[cast_floating_array(np.asarray(weights), dtype) for weights in model_params])
     else:
         raise ValueError('Unsupported training type', training_type)
+    return buffer.getvalue()
+
 
+def encode_params(training_type, model_params, dtype=None):
+    # Level 1 gives most of the size reduction of gzip for a fraction of its CPU cost
+    return gzip.compress(serialize_params(training_type, model_params, dtype), compresslevel=1)
 
-def request_params_to_model_params(training_type, request_data):
+
+def read_request_payload(request):
+    data = request.get_data()
+    if request.headers.get('Content-Encoding') == 'gzip':
+        # A small gzip body can expand to any size, so the output is bounded as well
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            data = decompressor.decompress(data, MAX_PAYLOAD_BYTES)
+        except zlib.error:
+            raise BadRequest('Invalid gzip payload')
+        if decompressor.unconsumed_tail:
+            raise RequestEntityTooLarge()
+        if not decompressor.eof:
+            raise BadRequest('Truncated gzip payload')
+    return data
+
+
+def deserialize_params(training_type, data):
+    if not data:
+        logger.warning('No model params found in the request')
+        return None
     model_params = None
-    if training_type == TrainingType.MNIST or training_type == TrainingType.DETERMINISTIC_MNIST:
-        weights = torch.tensor(np.array(request_data['weights']), dtype=torch.float, requires_grad=True)
-        bias = torch.tensor(np.array(request_data['bias']), dtype=torch.float, requires_grad=True)
-        model_params = weights, bias
-    elif training_type == TrainingType.CHEST_X_RAY_PNEUMONIA:
-        if 'weights' in request_data:
-            weights_array = []
-            weights_received = request_data['weights']
-            print('Weights received length:', len(weights_received))
-            for weights in weights_received:
-                numpy_weights_array = np.array(weights)
-                print('model weights SHAPE:', numpy_weights_array.shape)
-                weights_array.append(np.array(weights))
-            model_params = weights_array
+    with np.load(io.BytesIO(data)) as arrays:
+        if training_type == TrainingType.MNIST or training_type == TrainingType.DETERMINISTIC_MNIST:
+            # Plain tensors: the server only averages them, gradients are only needed on the clients
+            weights = torch.from_numpy(arrays['weights']).float()
+            bias = torch.from_numpy(arrays['bias']).float()
+            model_params = weights, bias
+        elif training_type == TrainingType.CHEST_X_RAY_PNEUMONIA:
+            # np.savez stores positional arrays as arr_0, arr_1... keeping the layers order.
+            # Params may come quantized, but they are always aggregated in float32
+            model_params = [
+                cast_floating_array(arrays['arr_{}'.format(i)], np.float32) for i in range(len(arrays.files))
+            ]
         else:
-            print('No weights found in the request')
-            return None
-    print('Model params received length:', len(model_params))
+            raise ValueError('Unsupported training type', training_type)
+    logger.info('Model params received length: %d', len(model_params))
     return model_params